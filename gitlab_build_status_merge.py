@@ -38,9 +38,73 @@ get a 100% accurate count of _actually_ pending builds due to lack of resources
 also include the "created" builds that are in a later, waiting stages a pipeline (and don't need
 a resource just yet). There doesn't appear to be _any_ tell tail sign from the build event
 which is which.
+
+To get a better sense of how long we're actually waiting we also keep some (optional) rolling
+statistics in a separate GITLAB_PIPELINE_STATS file. Each time a build first starts we record how
+long it waited since it became runnable, and each time it first finishes we record how long it ran.
+Only the last GITLAB_PIPELINE_STATS_WINDOW samples are kept per-project (and overall), so the file
+stays small and the radiator never has to scan the history.
+
+Because of the "created" problem above we can't just use the time since the build was created,
+that would include builds sitting in later stages waiting for earlier ones. Instead a build becomes
+runnable at the later of when it was created and when the last build in an earlier stage finished.
+Manual builds are waiting on a person, not a runner, so they're skipped entirely.
 """
 
 build_file = os.getenv("GITLAB_PIPELINE_CACHE")
+stats_file = os.getenv("GITLAB_PIPELINE_STATS")
+# Anything less than 1 would make the ring buffer unbounded (or wrong), see record_sample
+stats_window = max(1, int(os.getenv("GITLAB_PIPELINE_STATS_WINDOW") or "500"))
+
+def parse_time(s):
+  # Gitlab isn't consistent, depending on the version/event we get "2016-08-12 15:26:29 UTC" or ISO 8601
+  if not s:
+    return None
+  s = s.replace(" UTC", "").replace("Z", "").replace("T", " ").split(".")[0]
+  try:
+    return datetime.datetime.strptime(s[:19], "%Y-%m-%d %H:%M:%S")
+  except ValueError:
+    return None
+
+def seconds_between(start, end):
+  start, end = parse_time(start), parse_time(end)
+  if start is None or end is None:
+    return None
+  return max(0, int((end - start).total_seconds()))
+
+def build_pipeline_id(build):
+  # Older versions of gitlab don't have pipeline_id, but the "commit" is actually the pipeline
+  return build.get("pipeline_id") or (build.get("commit") or {}).get("id")
+
+def runnable_at(ref, job, build):
+  # Stages are only in the pipeline event, without them we can't tell what this build was waiting on
+  stages = ref["object_attributes"].get("stages")
+  stage = build.get("build_stage") or job.get("stage")
+  if not stages or stage not in stages:
+    return None
+  earlier = stages[:stages.index(stage)]
+  # NOTE: The builds can include other pipelines for this ref that are running at the same time,
+  # and gitlab creates all of a pipeline's builds up front, so we can only compare with our own pipeline
+  pipeline_id = build_pipeline_id(build) or job.get("pipeline_id")
+  if not pipeline_id:
+    return None
+  started = parse_time(build["build_started_at"])
+  times = [build.get("build_created_at")] + [
+    j.get("finished_at") for j in ref["builds"]
+    if j.get("pipeline_id") == pipeline_id and j.get("stage") in earlier
+    and parse_time(j.get("finished_at")) and parse_time(j.get("finished_at")) <= started
+  ]
+  times = [t for t in times if parse_time(t)]
+  return max(times, key=parse_time) if times else None
+
+def record_sample(stats, project, kind, seconds):
+  # A simple ring buffer, we only ever want the last N samples
+  for samples in [stats["overall"], stats["projects"].setdefault(project, {})]:
+    buf = samples.setdefault(kind, [])
+    buf.append(seconds)
+    del buf[:-stats_window]
+
+samples = []
 
 build = json.loads(sys.argv[1])
 
@@ -70,12 +134,20 @@ if build["object_kind"] == "pipeline":
       for b2 in old_builds:
         if b1["id"] == b2["id"]:
           b1["status"] = b2["status"]
+          # Needed to work out the queue time, see runnable_at
+          for k in ["stage", "when"]:
+            if k in b2:
+              b1[k] = b2[k]
+          b1["pipeline_id"] = build["object_attributes"]["id"]
 
     # Only update the pipeline if it's the "latest" one for this branch
     # Otherwise we accidentally hide "running" pipelines when someone updates a branch and the first build passes
     # We're relying on the fact that the pipeline IDs increase each time
     update = build["object_attributes"]["id"] >= job["object_attributes"]["id"]
   else:
+    # Pipeline events don't say which pipeline each build belongs to, but they're all this one
+    for b in build.get("builds") or []:
+      b["pipeline_id"] = build["object_attributes"]["id"]
     update = True
 
   if update:
@@ -96,6 +168,27 @@ elif build["object_kind"] == "build":
         ref["builds"].append({"id": build["build_id"]})
       for job in ref["builds"]:
         if job["id"] == build["build_id"]:
+          # Only record each build once, the pipeline event may have already filled in started_at/finished_at
+          sampled = job.setdefault("sampled", [])
+          manual = job.get("when") == "manual" or build["build_status"] == "manual"
+          if "wait" not in sampled and build["build_started_at"] and not manual:
+            sampled.append("wait")
+            wait = seconds_between(runnable_at(ref, job, build), build["build_started_at"])
+            if wait is not None:
+              samples.append(("wait", wait))
+          if "duration" not in sampled and build["build_finished_at"] and build["build_status"] in ["success", "failed"]:
+            sampled.append("duration")
+            duration = build.get("build_duration")
+            if duration is None:
+              duration = seconds_between(build["build_started_at"], build["build_finished_at"])
+            if duration is not None:
+              samples.append(("duration", int(duration)))
+          if build.get("build_stage"):
+            job["stage"] = build["build_stage"]
+          if build_pipeline_id(build):
+            job["pipeline_id"] = build_pipeline_id(build)
+          if build["build_status"] == "manual":
+            job["when"] = "manual"
           job["status"] = build["build_status"]
           job["started_at"] = build["build_started_at"]
           job["finished_at"] = build["build_finished_at"]
@@ -104,5 +197,23 @@ else:
   raise Exception("Unknown object_kind: {}".format(build["object_kind"]))
 
 
-with open(build_file, 'w') as f:
+# Write to a temporary file and rename so the radiator never reads a half-written file
+with open(build_file + ".tmp", 'w') as f:
   f.write(json.dumps(builds, indent=2))
+os.rename(build_file + ".tmp", build_file)
+
+if stats_file and samples:
+  try:
+    stats = json.loads(open(stats_file, 'r').read())
+  except:
+    stats = {}
+  stats.setdefault("overall", {})
+  stats.setdefault("projects", {})
+
+  for kind, seconds in samples:
+    record_sample(stats, project_name, kind, seconds)
+
+  # Write to a temporary file and rename so the radiator never reads a half-written file
+  with open(stats_file + ".tmp", 'w') as f:
+    f.write(json.dumps(stats))
+  os.rename(stats_file + ".tmp", stats_file)
@@ -5,6 +5,8 @@ This module is a _very_ simple Gitlab radiator dashboard.
 
 It also supports a rudimentary "investigation" for removing individual builds
 from the radiator to avoid "red build fatigue".
+Investigations are kept in memory and expire automatically once the pipeline
+is no longer the latest one for its branch, or it has gone green.
 
 ## HTTP Query parameters:
 
@@ -13,20 +15,34 @@ branch: [optional, list, default: master and develop branches]
 
 refresh: [optional, default: 60]
   Number of seconds before refreshing the page
+
+## Queue/build time statistics
+
+If GITLAB_PIPELINE_STATS is set (see `gitlab_build_status_merge.py`) the p50/p95
+wait and run times are shown on the page, and per-project at `/stats`.
 """
 
-import cgi, json, os, urlparse, re
+import cgi, json, os, urlparse, re, threading
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 from SocketServer import ThreadingMixIn
 
 gitlab_builds_file = os.getenv("GITLAB_PIPELINE_CACHE")
 port = os.getenv("GITLAB_RADIATOR_PORT") or "9004"
 investigations_file = os.getenv("GITLAB_RADIATOR_INVESTIGATIONS") or "/tmp/gitlab_radiator_investigations"
+stats_file = os.getenv("GITLAB_PIPELINE_STATS")
 # Regex on the full `PROJECT/repository`
 default_project_filters = []
 
 ###### Gitlab API ######
 
+def file_key(f):
+    # Enough to tell if a file has been changed since we last read it
+    try:
+      st = os.stat(f)
+      return (st.st_ino, st.st_mtime, st.st_ctime, st.st_size)
+    except (OSError, TypeError):
+      return None
+
 def load_builds():
     try:
       builds = json.loads(open(gitlab_builds_file, 'r').read())
@@ -35,59 +51,212 @@ def load_builds():
     return builds
 
 # https://docs.gitlab.com/ce/user/project/integrations/webhooks.html#build-events
-def get_builds(builds, filterBuild):
+def index_builds(builds):
     projects = [
-      { "project": {
-          "name": project.split("/")[1],
+      ( project,
+        { "name": project.split("/")[1],
           "namespace": { "name": project.split("/")[0] },
         },
-        "pipeline": [ {
-            "id": branch["object_attributes"]["id"],
-            "status": branch["object_attributes"]["status"],
-            "web_url": branch["project"]["web_url"] + "/pipelines/" + str(branch["object_attributes"]["id"])
-          }
+        [ ( { "id": branch["object_attributes"]["id"],
+              "status": branch["object_attributes"]["status"],
+              "web_url": branch["project"]["web_url"] + "/pipelines/" + str(branch["object_attributes"]["id"])
+            },
+            branch["object_attributes"]["ref"],
+            branch["object_attributes"].get("tag"),
+          )
           for branch in builds[project].values()
-          if filterBuild(branch)
         ],
-      }
+      )
       for project in builds
     ]
     return {
+        "builds": builds,
         "projects": projects,
+        # The status of every pipeline currently in the cache, ie the latest one for each branch
+        "pipelines": dict(
+          ((p["namespace"]["name"], p["name"], str(b["id"])), b["status"])
+          for _, p, bs in projects
+          for b, _, _ in bs
+        ),
         "running": build_status_count(builds, "running"),
         "pending": build_status_count(builds, "created") + build_status_count(builds, "pending"),
       }
 
-def filter_by_branch_status(branches, tags):
-  return lambda build: all([
-      build["object_attributes"]["status"] in ["failed"],
-      any([
-        build["object_attributes"]["ref"] in branches,
-        tags and build["object_attributes"]["tag"],
-      ]),
-    ])
-
-def filter_by_project_name(projects, regexs):
-    for regex in regexs:
-        projects = [
-          p for p in projects
-          if re.search(regex, p['project']['namespace']['name'] + "/" + p['project']['name']) is None
-          ]
-    return projects
+# The cache only changes when the merge rewrites it, so only re-parse/re-index when it does
+snapshot = { "key": None }
+snapshot_lock = threading.Lock()
+
+def load_snapshot():
+    key = file_key(gitlab_builds_file)
+    with snapshot_lock:
+      if key is None or key != snapshot["key"]:
+        builds = load_builds()
+        # Don't cache a missing/unreadable file, we'll pick it up properly on the next request
+        snapshot.update(index_builds(builds), key = key if builds else None)
+      return dict(snapshot)
+
+###### Queries ######
+
+queries = {}
+max_queries = 100
+
+def compile_query(path, query):
+    if path == "/current":
+        branches = None
+        tags = False
+        statuses = query.get("status") or ["running", "pending"]
+    else:
+        branches = query.get("branch") or ["master", "develop"]
+        tags = query.get("tags") != ["false"]
+        statuses = ["failed"]
+    project_filter = query.get("project_filter") or default_project_filters
+
+    key = (
+      branches and tuple(sorted(set(branches))),
+      tags,
+      tuple(sorted(set(statuses))),
+      tuple(sorted(set(project_filter))),
+    )
+    q = queries.get(key)
+    if q is None:
+        q = {
+          "branches": branches and frozenset(branches),
+          "tags": tags,
+          "statuses": frozenset(statuses),
+          # Regex on the full `PROJECT/repository`, any match excludes the project
+          "project_filter": [re.compile(r) for r in key[3]],
+        }
+        if len(queries) >= max_queries:
+            queries.clear()
+        queries[key] = q
+    return q
+
+def run_query(q, snapshot, ignore = ()):
+    """
+    Returns the matching pipelines grouped by project,
+    as well as how many were hidden by the `ignore`d investigations.
+    """
+    ps = []
+    ignored = 0
+    for path, p, bs in snapshot["projects"]:
+        if any(r.search(path) for r in q["project_filter"]):
+            continue
+        pipeline = []
+        for b, ref, tag in bs:
+            if b["status"] not in q["statuses"]:
+                continue
+            if q["branches"] is not None and not (ref in q["branches"] or (q["tags"] and tag)):
+                continue
+            if ignore and (p["namespace"]["name"], p["name"], str(b["id"])) in ignore:
+                ignored += 1
+                continue
+            pipeline.append(b)
+        if pipeline:
+            ps.append({ "project": p, "pipeline": pipeline })
+    return ps, ignored
+
+###### Statistics ######
+
+def load_stats():
+    try:
+      stats = json.loads(open(stats_file, 'r').read())
+    except:
+      stats = {}
+    return stats
+
+def percentile(samples, p):
+    s = sorted(samples)
+    return s[min(len(s) - 1, int(len(s) * p / 100))]
+
+def summarise_samples(samples):
+    return dict(
+        (kind, {
+          "count": len(xs),
+          "p50": percentile(xs, 50),
+          "p95": percentile(xs, 95),
+        })
+        for kind, xs in samples.items()
+        if xs
+    )
+
+# Only re-summarise when the merge rewrites the stats file, and the projects only when asked for
+stats_summary = { "key": None }
+stats_lock = threading.Lock()
+
+def get_stats(projects = False):
+    key = file_key(stats_file)
+    with stats_lock:
+      if key is None or key != stats_summary["key"]:
+        stats = load_stats()
+        stats_summary.update(
+          key = key,
+          samples = stats.get("projects") or {},
+          overall = summarise_samples(stats.get("overall") or {}),
+          projects = None,
+        )
+      if projects and stats_summary["projects"] is None:
+        stats_summary["projects"] = dict(
+          (project, summarise_samples(samples))
+          for project, samples in stats_summary["samples"].items()
+        )
+      ss = { "overall": stats_summary["overall"] }
+      if projects:
+        ss["projects"] = stats_summary["projects"]
+      return ss
+
+def format_seconds(s):
+    return "{}m{:02d}s".format(s // 60, s % 60) if s >= 60 else "{}s".format(s)
+
+def stats_html(ss):
+    return "".join(
+        "<div>{} {} / {}</div>".format(
+          name,
+          format_seconds(ss["overall"][kind]["p50"]),
+          format_seconds(ss["overall"][kind]["p95"]),
+        )
+        for kind, name in [("wait", "&#10073;&#10073;"), ("duration", "&#x25b6;")]
+        if ss["overall"].get(kind)
+    )
 
 ###### Radiator #######
 
+# Keyed by (group, project, pipeline id), guarded by a lock because the server is threaded
+investigations = set()
+investigations_lock = threading.Lock()
+
 def read_investigations():
   try:
       with open(investigations_file, "r") as f:
-          investigations = set(f.read().splitlines())
+          return set(tuple(line.split(" ", 2)) for line in f.read().splitlines() if line.count(" ") >= 2)
   except IOError:
-      investigations = []
-  return investigations
+      return set()
+
+def write_investigations(i):
+    # Write to a temporary file and rename so we never leave a half-written file behind
+    tmp = investigations_file + ".tmp"
+    with open(tmp, "w") as f:
+        f.write("".join("{} {} {}\n".format(g, p, b) for (g, p, b) in sorted(i)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, investigations_file)
 
 def append_investigation(g, p, i):
-    with open(investigations_file, "a+") as f:
-        f.write("{} {} {}\n".format(g, p, i))
+    with investigations_lock:
+        investigations.add((g, p, str(i)))
+        write_investigations(investigations)
+
+def expire_investigations(snapshot):
+    # Don't throw everything away if the cache is missing or unreadable
+    if not snapshot["builds"]:
+        return
+    # Only the latest pipeline per branch is in the cache, so anything else has been superseded.
+    # Retrying a build will make it running/pending again, we only want to forget it once it's green.
+    pipelines = snapshot["pipelines"]
+    with investigations_lock:
+        expired = set(i for i in investigations if pipelines.get(i, "success") == "success")
+        if expired:
+            investigations.difference_update(expired)
+            write_investigations(investigations)
 
 def build_html(redirect, x):
     p = x["project"]
@@ -116,19 +285,6 @@ def build_html(redirect, x):
     ]
     return "".join(y)
 
-def filter_builds_by_investigation(i, ps):
-    ps2 = []
-    for x in ps:
-        p = x["project"]
-        b2 = { "project": p, "pipeline": [] }
-        for b in x["pipeline"]:
-            line = "{} {} {}".format(p["namespace"]["name"], p["name"], b["id"])
-            if line not in i:
-                b2["pipeline"].append(b)
-        if len(b2["pipeline"]) > 0:
-          ps2.append(b2)
-    return ps2
-
 def pipeline_success(ps):
     return sum(sum(1 for y in p["pipeline"] if y["status"] == "failed") for p in ps) == 0
 
@@ -140,7 +296,7 @@ def build_status_count(ps, s):
         ) for p in ps
     )
 
-def html_pipelines(path, refresh, ps, bs):
+def html_pipelines(path, refresh, ps, bs, ss):
     return """
         <html>
           <head>
@@ -164,6 +320,12 @@ def html_pipelines(path, refresh, ps, bs):
               .running-count td {{
                 text-align: center;
               }}
+              #stats {{
+                font-size: 46px;
+                position: fixed;
+                bottom: 0px;
+                left: 0px;
+              }}
               #timer {{
                 font-size: 46px;
                 position: fixed;
@@ -218,6 +380,7 @@ def html_pipelines(path, refresh, ps, bs):
               <tr><td>{}</td><td style="color: #1f78d1;">&#x25b6;</span></td></tr>
               <tr><td>{}</td><td style="color: #fc9403;">&#10073;&#10073;</span></td></tr>
             </div>
+            <div id="stats" title="p50 / p95">{}</div>
             <div id="timer"></div>
           </body>
         </html>
@@ -228,6 +391,7 @@ def html_pipelines(path, refresh, ps, bs):
       "".join(map(lambda x: build_html(path, x), ps)),
       bs["running"],
       bs["pending"],
+      stats_html(ss),
     )
 
 class RadiatorRequestHandler(BaseHTTPRequestHandler):
@@ -248,77 +412,57 @@ class RadiatorRequestHandler(BaseHTTPRequestHandler):
         url = urlparse.urlparse(self.path)
         query = urlparse.parse_qs(url.query)
 
-        if url.path == "/":
-
-            branches = query.get("branch") or ["master", "develop"]
-            tags = query.get("tags") != ["false"]
-            project_filter = query.get("project_filter") or default_project_filters
-
-            lb = load_builds()
-            bs = get_builds(lb, filter_by_branch_status(branches, tags))
-            ps = filter_by_project_name(bs["projects"], project_filter)
-
-            self.send_response(200 if pipeline_success(ps) else 400)
-            self.send_header("Content-Type", "text/html")
-            self.end_headers()
-
-            self.wfile.write(html_pipelines(
-                self.path,
-                "".join(query.get("refresh") or ["60"]),
-                filter_builds_by_investigation(read_investigations(), ps),
-                bs,
-            ))
+        if url.path in ["/", "/status", "/current"]:
+
+            q = compile_query(url.path, query)
+            bs = load_snapshot()
+            # Investigations only apply to the broken builds
+            if url.path != "/current":
+                expire_investigations(bs)
+                ps, ignored = run_query(q, bs, investigations)
+            else:
+                ps, ignored = run_query(q, bs)
+
+            # FIXME Same as "/", we should use Accept headers instead
+            if url.path == "/status":
+                self.send_response(200 if pipeline_success(ps) else 400)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+
+                self.wfile.write(json.dumps(ps, indent=2))
+            else:
+                if url.path == "/current":
+                    self.send_response(200)
+                else:
+                    # Still report investigated builds as broken, just don't show them
+                    self.send_response(200 if pipeline_success(ps) and not ignored else 400)
+                self.send_header("Content-Type", "text/html")
+                self.end_headers()
+
+                self.wfile.write(html_pipelines(
+                    self.path,
+                    "".join(query.get("refresh") or ["60"]),
+                    ps,
+                    bs,
+                    get_stats(),
+                ))
             self.wfile.close()
 
-        # FIXME Same as "/", we should use Accept headers instead
-        elif url.path == "/status":
-
-            branches = query.get("branch") or ["master", "develop"]
-            tags = query.get("tags") != ["false"]
-            project_filter = query.get("project_filter") or default_project_filters
-
-            lb = load_builds()
-            builds = get_builds(lb, filter_by_branch_status(branches, tags))
-            fp = filter_by_project_name(builds["projects"], project_filter)
-            ps = filter_builds_by_investigation(read_investigations(), fp)
-
-            self.send_response(200 if pipeline_success(ps) else 400)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-
-            self.wfile.write(json.dumps(ps, indent=2))
-            self.wfile.close()
-
-        elif url.path == "/current":
-
-            statuses = query.get("status") or ["running", "pending"]
-            project_filter = query.get("project_filter") or default_project_filters
-
-            lb = load_builds()
-            bs = get_builds(lb, lambda build:
-              build["object_attributes"]["status"] in statuses
-            )
-            ps = filter_by_project_name(bs["projects"], project_filter)
+        elif url.path == "/all":
+            lb = load_snapshot()["builds"]
 
             self.send_response(200)
-            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Type", "application/json")
             self.end_headers()
-
-            self.wfile.write(html_pipelines(
-                self.path,
-                "".join(query.get("refresh") or ["60"]),
-                ps,
-                bs,
-            ))
+            self.wfile.write(json.dumps(lb, indent=2))
             self.wfile.close()
 
-        elif url.path == "/all":
-            lb = load_builds()
+        elif url.path == "/stats":
 
             self.send_response(200)
             self.send_header("Content-Type", "application/json")
             self.end_headers()
-            self.wfile.write(json.dumps(lb, indent=2))
+            self.wfile.write(json.dumps(get_stats(projects = True), indent=2))
             self.wfile.close()
 
         elif url.path == "/investigations":
@@ -327,7 +471,9 @@ class RadiatorRequestHandler(BaseHTTPRequestHandler):
             self.send_header("Content-Type", "text/plain")
             self.end_headers()
 
-            self.wfile.write("\n".join(read_investigations()))
+            with investigations_lock:
+                lines = sorted(" ".join(i) for i in investigations)
+            self.wfile.write("\n".join(lines))
             self.wfile.close()
 
         else:
@@ -343,6 +489,8 @@ class RadiatorRequestHandler(BaseHTTPRequestHandler):
 class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
     """Handle requests in a separate thread."""
 
-httpd = ThreadedHTTPServer(("", int(port)), RadiatorRequestHandler)
-print("serving at port", port)
-httpd.serve_forever()
+if __name__ == "__main__":
+    investigations.update(read_investigations())
+    httpd = ThreadedHTTPServer(("", int(port)), RadiatorRequestHandler)
+    print("serving at port", port)
+    httpd.serve_forever()
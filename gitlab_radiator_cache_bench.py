@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""
+A micro-benchmark for the radiator queries over a large synthetic pipeline cache.
+
+> python ./gitlab_radiator_cache_bench.py [projects] [branches]
+"""
+
+import json, os, random, sys, tempfile, timeit
+
+import gitlab_radiator_cache as radiator
+
+statuses = ["failed", "success", "running", "pending", "canceled"]
+
+def synthetic_builds(projects, branches):
+    random.seed(0)
+    builds = {}
+    pipeline_id = 0
+    for i in range(projects):
+        project = "PRJ{}/repo-{}".format(i % 50, i)
+        builds[project] = {}
+        for j in range(branches):
+            pipeline_id += 1
+            ref = ["master", "develop"][j] if j < 2 else "feature/{}".format(j)
+            builds[project][ref] = {
+              "object_kind": "pipeline",
+              "project": { "path_with_namespace": project, "web_url": "https://gitlab/" + project },
+              "object_attributes": {
+                "id": pipeline_id,
+                "ref": ref,
+                "tag": j % 10 == 9,
+                "status": random.choice(statuses),
+              },
+              "builds": [ { "id": pipeline_id * 10 + k, "status": random.choice(statuses) } for k in range(5) ],
+            }
+    return builds
+
+def run(projects, branches):
+    f = tempfile.NamedTemporaryFile(suffix=".json", delete=False)
+    f.write(json.dumps(synthetic_builds(projects, branches)))
+    f.close()
+    radiator.gitlab_builds_file = f.name
+
+    queries = [
+      ("/", {}),
+      ("/", { "branch": ["master"], "tags": ["false"], "project_filter": ["^PRJ1/", "repo-9", "-4$"] }),
+      ("/current", {}),
+      ("/current", { "status": ["failed", "running"], "project_filter": ["^PRJ2"] }),
+    ]
+    number = 20
+
+    try:
+        print("{} projects, {} branches".format(projects, branches))
+        t = timeit.timeit(lambda: radiator.index_builds(radiator.load_builds()), number=number) / number
+        print("  load + index:    {:8.2f}ms".format(t * 1000))
+        bs = radiator.load_snapshot()
+        t = timeit.timeit(radiator.load_snapshot, number=number) / number
+        print("  cached snapshot: {:8.2f}ms".format(t * 1000))
+        for path, query in queries:
+            t = timeit.timeit(lambda: radiator.run_query(radiator.compile_query(path, query), bs), number=number) / number
+            ps, _ = radiator.run_query(radiator.compile_query(path, query), bs)
+            print("  {:8} {:70} {:8.2f}ms {:6} pipelines".format(
+              path,
+              json.dumps(query),
+              t * 1000,
+              sum(len(p["pipeline"]) for p in ps),
+            ))
+    finally:
+        os.remove(f.name)
+
+if __name__ == "__main__":
+    run(
+      int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+      int(sys.argv[2]) if len(sys.argv) > 2 else 20,
+    )